@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from tools import Api
 import prompt
 from .load_agent import create_agent_with_api_key_rotation, key_manager
@@ -29,39 +30,37 @@ main_agent = create_agent_with_api_key_rotation(
 )
 
 # ===============================
-# Search Agents (Multiple instances)
+# Search / VLM Agents (Multiple instances)
 # ===============================
-def create_search_agent(agent_id: int):
-    """Tạo Search agent với API key rotation"""
+def create_role_agent(role: str, index: int, instruction: str, tools=None):
+    """Tạo agent thứ index của một role (search/vlm) theo template trong config"""
+    role_config = config["agents"][role]
     return create_agent_with_api_key_rotation(
-        name=config["agents"]["search"]["name_template"].format(id=agent_id),
-        model=config["agents"]["search"]["model"],
-        agent_id=agent_id,
-        description=config["agents"]["search"]["description_template"].format(id=agent_id),
-        instruction=prompt.SEARCH_AGENT_PROMPT,
-        tools=[tool_image_search],
-        output_key=f"search_result_{agent_id}"
+        name=role_config["name_template"].format(id=index),
+        model=role_config["model"],
+        # agent_id_start khác nhau giữa các role để phân bổ key khác nhau
+        agent_id=role_config["agent_id_start"] + index - 1,
+        description=role_config["description_template"].format(id=index),
+        instruction=instruction,
+        tools=tools,
+        output_key=role_config["output_key_template"].format(id=index),
     )
 
-# Tạo danh sách Search agents
-search_agents = [create_search_agent(i) for i in range(1, 4)]  # 3 Search agents
+@lru_cache(maxsize=None)
+def create_search_agent(agent_id: int):
+    """Tạo Search agent với API key rotation (mỗi agent_id chỉ tạo một lần)"""
+    # Mỗi agent đọc sub-query của mình từ state key search_query_{agent_id}
+    instruction = prompt.SEARCH_AGENT_PROMPT.format(id=agent_id)
+    return create_role_agent("search", agent_id, instruction, tools=[tool_image_search])
 
-# ===============================
-# VLM Agents 
-# ===============================
+@lru_cache(maxsize=None)
 def create_vlm_agent(agent_id: int):
-    """Tạo VLM agent với API key rotation"""
-    return create_agent_with_api_key_rotation(
-        name=f'VLMAgent{agent_id}',
-        model = config["agents"]["vlm"]["model"],
-        agent_id=agent_id + 10,  # Offset để phân bổ key khác với search agents
-        description=f"VLM Agent #{agent_id} - Phân tích ảnh và trả lời câu hỏi",
-        instruction=prompt.VLM_AGENT_PROMPT,
-        output_key=f"vlm_result_{agent_id}"
-    )
+    """Tạo VLM agent với API key rotation (mỗi agent_id chỉ tạo một lần)"""
+    return create_role_agent("vlm", agent_id, prompt.VLM_AGENT_PROMPT)
 
-# Tạo danh sách VLM agents
-vlm_agents = [create_vlm_agent(i) for i in range(1, 6)]  # 5 VLM agents
+# Tạo danh sách Search agents và VLM agents theo số lượng trong config
+search_agents = [create_search_agent(i) for i in range(1, config["agents"]["search"]["count"] + 1)]
+vlm_agents = [create_vlm_agent(i) for i in range(1, config["agents"]["vlm"]["count"] + 1)]
 
 # ===============================
 # Aggregator Agent
@@ -71,7 +70,10 @@ aggregator_agent = create_agent_with_api_key_rotation(
     model=config["agents"]["aggregator"]["model"],
     agent_id=config["agents"]["aggregator"]["agent_id"], 
     description=config["agents"]["aggregator"]["description"],
-    instruction=prompt.AGGREGATOR_AGENT_PROMPT
+    instruction=prompt.AGGREGATOR_AGENT_PROMPT,
+    output_key=config["agents"]["aggregator"]["output_key"],
+    # Aggregator chỉ đọc câu hỏi và các câu trả lời VLM trong state, không cần toàn bộ lịch sử
+    include_contents="none",
 )
 # In thống kê API key usage
 print("\n" + "="*50)
@@ -1,13 +1,25 @@
-import threading
+import asyncio
+import itertools
+import logging
 import os
-import time
+import ssl
+import weakref
+from contextlib import nullcontext
+import certifi
 from dotenv import load_dotenv
+from functools import cached_property
+import httpx
 from google.adk.agents import LlmAgent
-from google.genai import types
+from google.adk.models import Gemini
+from google.adk.models.llm_request import LlmRequest
+from google.genai import Client, types
+from pydantic import Field
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 class ApiKeyManager:
     """Quản lý xoay vòng API keys để tránh quota limit"""
     
@@ -34,8 +46,13 @@ class ApiKeyManager:
             self.api_keys = []
         
         self.current_index = 0
-        self.lock = threading.Lock()
+        # itertools.count là C-level, next() nguyên tử dưới GIL nên không cần lock
+        self._counter = itertools.count()
         self.usage_count = {key: 0 for key in self.api_keys}
+        # Số request Gemini chạy đồng thời tối đa trên mỗi key (quota tính theo key)
+        self.max_in_flight_per_key = int(os.getenv('GEMINI_MAX_IN_FLIGHT_PER_KEY', '4'))
+        # event loop -> {key: Semaphore}; Semaphore gắn với loop nên tách theo từng loop
+        self._key_slots = weakref.WeakKeyDictionary()
         
         print(f"🔑 Initialized API Key Manager with {len(self.api_keys)} keys")
         if self.api_keys:
@@ -46,13 +63,13 @@ class ApiKeyManager:
         if not self.api_keys:
             raise ValueError("No API keys available. Please check your config.env file.")
             
-        with self.lock:
-            key = self.api_keys[self.current_index]
-            self.usage_count[key] += 1
-            self.current_index = (self.current_index + 1) % len(self.api_keys)
-            
-            print(f"🔄 Using API Key #{self.current_index} (used {self.usage_count[key]} times)")
-            return key
+        index = next(self._counter) % len(self.api_keys)
+        key = self.api_keys[index]
+        self.usage_count[key] += 1
+        self.current_index = (index + 1) % len(self.api_keys)
+        
+        logger.debug("🔄 Using API Key #%d (used %d times)", index + 1, self.usage_count[key])
+        return key
     
     def get_key_for_agent(self, agent_id: int):
         """Lấy key cố định cho agent dựa trên ID (load balancing)"""
@@ -63,22 +80,35 @@ class ApiKeyManager:
         key = self.api_keys[key_index]
         self.usage_count[key] += 1
         
-        print(f"🎯 Agent {agent_id} -> API Key #{key_index + 1} (used {self.usage_count[key]} times)")
+        logger.debug("🎯 Agent %d -> API Key #%d (used %d times)", agent_id, key_index + 1, self.usage_count[key])
         return key
     
+    def acquire(self, key: str):
+        """Slot của key (dùng với async with) để giới hạn số request Gemini đang chạy trên key đó"""
+        if self.max_in_flight_per_key <= 0:
+            return nullcontext()
+        slots = self._key_slots.setdefault(asyncio.get_running_loop(), {})
+        semaphore = slots.get(key)
+        if semaphore is None:
+            semaphore = slots[key] = asyncio.Semaphore(self.max_in_flight_per_key)
+        return semaphore
+    
     def print_usage_stats(self):
         """In thống kê sử dụng keys"""
-        print("📊 API Key Usage Statistics:")
+        lines = ["📊 API Key Usage Statistics:"]
         total_requests = sum(self.usage_count.values())
         for i, key in enumerate(self.api_keys):
             count = self.usage_count[key]
             percentage = (count / total_requests * 100) if total_requests > 0 else 0
-            print(f"  Key #{i+1}: {count} requests ({percentage:.1f}%)")
-        print(f"  Total: {total_requests} requests across {len(self.api_keys)} keys")
+            lines.append(f"  Key #{i+1}: {count} requests ({percentage:.1f}%)")
+        lines.append(f"  Total: {total_requests} requests across {len(self.api_keys)} keys")
+        # Ghi một lần thay vì print từng dòng
+        print("\n".join(lines))
     
     def reset_usage_stats(self):
         """Reset usage statistics"""
-        self.usage_count = {key: 0 for key in self.api_keys}
+        # Reset tại chỗ để các nơi đang giữ tham chiếu tới usage_count vẫn thấy số liệu mới
+        self.usage_count.update(dict.fromkeys(self.usage_count, 0))
         print("🔄 API Key usage statistics reset!")
 
 # Global key manager
@@ -87,29 +117,94 @@ key_manager = ApiKeyManager()
 # ===============================
 # Dynamic API Key Setting
 # ===============================
+# Pool kết nối của httpx mặc định chỉ có 10 kết nối, không đủ cho các agent chạy song song
+_HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=25)
+
+# Kết nối trong pool gắn với event loop đã mở nó, nên mỗi loop có bộ client riêng
+_loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+_sync_clients = {}
+
+def _make_genai_client(api_key: str, headers: tuple) -> Client:
+    # Có transport thì genai dùng httpx (giữ pool) thay vì aiohttp mở session mới mỗi request.
+    # httpx bỏ qua verify của client khi có transport nên SSL context (như mặc định của genai) đặt vào transport
+    ssl_context = ssl.create_default_context(
+        cafile=os.environ.get("SSL_CERT_FILE", certifi.where()),
+        capath=os.environ.get("SSL_CERT_DIR"),
+    )
+    return Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            headers=dict(headers),
+            async_client_args={"transport": httpx.AsyncHTTPTransport(verify=ssl_context, limits=_HTTP_LIMITS)},
+        ),
+    )
+
+def get_genai_client(api_key: str, headers: tuple = ()) -> Client:
+    """Client genai dùng chung cho mọi agent có cùng API key (trong cùng event loop)"""
+    try:
+        clients = _loop_clients.setdefault(asyncio.get_running_loop(), {})
+    except RuntimeError:
+        clients = _sync_clients
+    client = clients.get((api_key, headers))
+    if client is None:
+        client = clients[(api_key, headers)] = _make_genai_client(api_key, headers)
+    return client
+
+class KeyedGemini(Gemini):
+    """Gemini model với client riêng mang API key cố định (không đọc os.environ)"""
+
+    api_key: str = Field(default="", exclude=True, repr=False)
+
+    @property
+    def api_client(self) -> Client:
+        return get_genai_client(self.api_key, tuple(sorted(self._tracking_headers.items())))
+
+    async def generate_content_async(self, llm_request: LlmRequest, stream: bool = False):
+        # Mỗi key chỉ có tối đa max_in_flight_per_key request cùng lúc, phần còn lại xếp hàng FIFO
+        async with key_manager.acquire(self.api_key):
+            async for response in super().generate_content_async(llm_request, stream):
+                yield response
+
+    @cached_property
+    def _live_api_client(self) -> Client:
+        return Client(
+            api_key=self.api_key,
+            http_options=types.HttpOptions(
+                headers=self._tracking_headers, api_version=self._live_api_version
+            ),
+        )
+
+# Tên agent -> số thứ tự API key (tính sẵn khi tạo agent), để callback dùng chung tra cứu
+_agent_key_numbers = {}
+
+def _before_agent(callback_context):
+    """Log API key agent đang dùng trước khi chạy"""
+    if logger.isEnabledFor(logging.INFO):
+        name = callback_context.agent_name
+        logger.info("🔑 %s using API Key #%d", name, _agent_key_numbers[name])
+
+def _after_agent(callback_context):
+    """Callback sau khi agent hoàn thành"""
+    logger.info("✅ %s completed!", callback_context.agent_name)
+
 def create_agent_with_api_key_rotation(name: str, model: str, agent_id: int, description: str, 
-                                     instruction: str, tools=None, output_key=None, temperature= None):
-    """Tạo agent với API key rotation qua callbacks"""
+                                     instruction: str, tools=None, output_key=None, temperature= None,
+                                     include_contents: str = "default"):
+    """Tạo agent với API key rotation: mỗi agent có client Gemini riêng theo key được gán"""
     
     assigned_key = key_manager.get_key_for_agent(agent_id)
-    
-    def before_callback(callback_context):
-        """Set API key trước khi agent chạy"""
-        os.environ['GEMINI_API_KEY'] = assigned_key
-        print(f"[{time.time():.3f}] 🔑 {name} using API Key #{(agent_id % len(key_manager.api_keys)) + 1}")
-    
-    def after_callback(callback_context):
-        """Callback sau khi agent hoàn thành"""
-        print(f"[{time.time():.3f}] ✅ {name} completed!")
+    _agent_key_numbers[name] = (agent_id % len(key_manager.api_keys)) + 1
     
     agent_kwargs = {
         'name': name,
-        'model': model,
+        'model': KeyedGemini(model=model, api_key=assigned_key),
         'description': description,
         'instruction': instruction,
         'generate_content_config': types.GenerateContentConfig(temperature=temperature),
-        'before_agent_callback': before_callback,
-        'after_agent_callback': after_callback
+        'include_contents': include_contents,
+        # Một callback dùng chung cho mọi agent, agent được xác định qua callback_context
+        'before_agent_callback': _before_agent,
+        'after_agent_callback': _after_agent
     }
     
     if tools:
@@ -1,13 +1,17 @@
 import os
 import asyncio
 import logging
+import uuid
+from contextlib import aclosing
+from functools import lru_cache
 from dotenv import load_dotenv
-from google.adk.sessions import InMemorySessionService
-from google.adk.runners import Runner
 from google.genai import types
-from workflow.cosmo_workflow import CosmoFlowAgent
-from agent.agent import main_agent, search_agents, vlm_agents, aggregator_agent
-from utils.helper_workflow import load_config
+from utils.helper_workflow import load_config, setup_logging
+try:
+    # uvloop chỉ có trên Linux/macOS; trên Windows dùng event loop mặc định của asyncio
+    import uvloop
+except ImportError:
+    uvloop = None
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config", "config.yaml")
 config = load_config(config_path=CONFIG_PATH)
 load_dotenv()
@@ -18,28 +22,29 @@ USER_ID = config["app"]["user_id"]
 SESSION_ID = config["app"]["session_id"]
 
 # --- Configure Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-cosmo_flow_agent = CosmoFlowAgent(  
-    name="CosmoFlowAgent",  
-    main_agent=main_agent,  
-    search_agents=search_agents,  
-    vlm_agents=vlm_agents,  
-    aggregator_agent=aggregator_agent,  
-)
+@lru_cache(maxsize=None)
+def get_session_service_and_runner():
+    """
+    Tạo (một lần) CosmoFlowAgent, session service và Runner dùng chung cho mọi query.
 
-async def setup_session_and_runner():
-    """Setup session service và runner"""
-    session_service = InMemorySessionService()
-    session = await session_service.create_session(
-        app_name=APP_NAME, 
-        user_id=USER_ID, 
-        session_id=SESSION_ID, 
-        state={}
+    ADK và các agent chỉ được import khi chạy workflow lần đầu, để CLI khởi động nhanh.
+    """
+    from google.adk.runners import Runner
+    from google.adk.sessions import InMemorySessionService
+    from agent.agent import main_agent, search_agents, vlm_agents, aggregator_agent
+    from workflow.cosmo_workflow import CosmoFlowAgent
+
+    cosmo_flow_agent = CosmoFlowAgent(  
+        name="CosmoFlowAgent",  
+        main_agent=main_agent,  
+        search_agents=search_agents,  
+        vlm_agents=vlm_agents,  
+        aggregator_agent=aggregator_agent,  
     )
-    logger.info(f"Session created: {session.state}")
-    
+    session_service = InMemorySessionService()
     runner = Runner(
         agent=cosmo_flow_agent,
         app_name=APP_NAME,
@@ -47,6 +52,23 @@ async def setup_session_and_runner():
     )
     return session_service, runner
 
+def _user_content(text: str) -> types.Content:
+    """Đóng gói text của user thành Content gửi cho Runner (bỏ qua validate của pydantic)"""
+    return types.Content.model_construct(role='user', parts=[types.Part.model_construct(text=text)])
+
+async def setup_session_and_runner():
+    """Tạo session mới (id riêng cho từng query) trên session service dùng chung"""
+    session_service, runner = get_session_service_and_runner()
+    session_id = f"{SESSION_ID}_{uuid.uuid4().hex}"
+    session = await session_service.create_session(
+        app_name=APP_NAME, 
+        user_id=USER_ID, 
+        session_id=session_id, 
+        state={}
+    )
+    logger.info("Session created: %s", session.state)
+    return session_service, runner, session_id
+
 
 async def run_cosmo_workflow(user_query: str):
     """
@@ -58,65 +80,109 @@ async def run_cosmo_workflow(user_query: str):
     Returns:
         str: Câu trả lời cuối cùng
     """
-    logger.info(f"🚀 Starting Cosmo Workflow")
-    logger.info(f"📝 User Query: {user_query}")
+    logger.info("🚀 Starting Cosmo Workflow")
+    logger.info("📝 User Query: %s", user_query)
     logger.info("="*80)
     
+    session_id = None
     try:
         # Setup session và runner
-        session_service, runner = await setup_session_and_runner()
+        session_service, runner, session_id = await setup_session_and_runner()
         
         # Tạo content từ user query
-        content = types.Content(
-            role='user', 
-            parts=[types.Part(text=user_query)]
-        )
+        content = _user_content(user_query)
         
         # Chạy workflow
         logger.info("🎯 Executing workflow...")
         events = runner.run_async(
             user_id=USER_ID, 
-            session_id=SESSION_ID, 
+            session_id=session_id, 
             new_message=content
         )
         
         # Thu thập kết quả
         final_response = "No final response captured."
-        async for event in events:
-            if event.is_final_response() and event.content and event.content.parts:
-                logger.info(f"📋 Final response from [{event.author}]")
-                final_response = event.content.parts[0].text
+        async with aclosing(events):
+            async for event in events:
+                # Event không có nội dung (function call/response rỗng...) bỏ qua trước khi kiểm tra final
+                event_content = event.content
+                if not (event_content and event_content.parts):
+                    continue
+                if event.is_final_response():
+                    logger.info("📋 Final response from [%s]", event.author)
+                    final_response = event_content.parts[0].text
+                    # Câu trả lời của root agent là event cuối cùng cần dùng, không chờ phần còn lại
+                    if event.author == runner.agent.name:
+                        break
         
-        # In kết quả
-        print("\n" + "="*80)
-        print("🎉 COSMO WORKFLOW RESULT")
-        print("="*80)
-        print(f"📝 Query: {user_query}")
-        print(f"💬 Answer: {final_response}")
-        print("="*80)
+        # In kết quả bằng một lần ghi để các query chạy song song không in xen kẽ nhau
+        print("\n".join([
+            "\n" + "="*80,
+            "🎉 COSMO WORKFLOW RESULT",
+            "="*80,
+            f"📝 Query: {user_query}",
+            f"💬 Answer: {final_response}",
+            "="*80,
+        ]))
         
         # In thống kê session
         final_session = await session_service.get_session(
             app_name=APP_NAME, 
             user_id=USER_ID, 
-            session_id=SESSION_ID
+            session_id=session_id
         )
         
         if final_session:
             logger.info("📊 Final Session State:")
             for key, value in final_session.state.items():
                 if isinstance(value, str) and len(value) > 100:
-                    logger.info(f"  {key}: {value[:100]}...")
+                    logger.info("  %s: %s...", key, value[:100])
                 else:
-                    logger.info(f"  {key}: {value}")
+                    logger.info("  %s: %s", key, value)
         
         return final_response
         
     except Exception as e:
-        logger.error(f"❌ Workflow error: {str(e)}")
-        error_message = f"Xin lỗi, có lỗi xảy ra trong quá trình xử lý: {str(e)}"
+        err = str(e)
+        logger.error("❌ Workflow error: %s", err)
+        error_message = f"Xin lỗi, có lỗi xảy ra trong quá trình xử lý: {err}"
         print(f"\n❌ Error: {error_message}")
         return error_message
+    finally:
+        # Session service dùng chung: xoá session của query (kể cả khi lỗi) để không giữ state của mọi query
+        if session_id is not None:
+            await session_service.delete_session(
+                app_name=APP_NAME,
+                user_id=USER_ID,
+                session_id=session_id
+            )
+
+
+async def batch_process_queries(queries, concurrency_limit: int = 3):
+    """
+    Chạy nhiều query đồng thời, mỗi query có session riêng
+
+    Args:
+        queries (list[str]): Danh sách câu hỏi
+        concurrency_limit (int): Số workflow chạy cùng lúc tối đa (giới hạn lời gọi LLM)
+
+    Returns:
+        list: Câu trả lời theo đúng thứ tự queries
+    """
+    semaphore = asyncio.Semaphore(concurrency_limit)
+
+    async def _run(query):
+        async with semaphore:
+            return await run_cosmo_workflow(query)
+
+    if not hasattr(asyncio, "TaskGroup"):
+        # Python 3.10 chưa có TaskGroup; run_cosmo_workflow tự bắt lỗi nên gather là đủ
+        return await asyncio.gather(*(_run(query) for query in queries))
+
+    # TaskGroup: nếu một task lỗi ngoài dự kiến, các task còn lại được huỷ gọn gàng
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_run(query)) for query in queries]
+    return [task.result() for task in tasks]
 
 
 def main():
@@ -138,10 +204,13 @@ def main():
     print("\n" + "="*60)
     
     # Cho phép user nhập query hoặc chọn test query
-    user_input = input("Enter your query (or press Enter for test query 1): ").strip()
+    user_input = input("Enter your query (or press Enter for test query 1, 'all' for every test query): ").strip()
     
     # Xử lý lựa chọn số
-    if user_input.isdigit():
+    run_all = user_input.lower() == "all"
+    if run_all:
+        print(f"Running all {len(test_queries)} test queries concurrently")
+    elif user_input.isdigit():
         choice = int(user_input) - 1
         if 0 <= choice < len(test_queries):
             user_input = test_queries[choice]
@@ -153,9 +222,18 @@ def main():
         user_input = test_queries[0]
         print(f"Using test query 1: {user_input}")
     
-    # Chạy workflow
+    workflow = batch_process_queries(test_queries) if run_all else run_cosmo_workflow(user_input)
     try:
-        result = asyncio.run(run_cosmo_workflow(user_input))
+        if hasattr(asyncio, "Runner"):
+            # Chạy workflow trên uvloop (nếu có) mà không đổi event loop policy toàn cục
+            loop_factory = uvloop.new_event_loop if uvloop is not None else None
+            with asyncio.Runner(loop_factory=loop_factory) as loop_runner:
+                loop_runner.run(workflow)
+        else:
+            # Python 3.10 chưa có asyncio.Runner: đặt uvloop làm event loop policy rồi dùng asyncio.run
+            if uvloop is not None:
+                uvloop.install()
+            asyncio.run(workflow)
         print(f"\n✅ Workflow completed successfully!")
         
     except KeyboardInterrupt:
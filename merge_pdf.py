@@ -1,19 +1,26 @@
 import img2pdf
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
 
 folder = Path(r"/home/namdp/Downloads/cosmo_data/output_quyen3")
 output_pdf = Path(r"/home/namdp/Downloads/cosmo_data_outputQuyen3_end.pdf")
 
+_NUMSPLIT = re.compile(r'(\d+)')
+
 def natural_key(p: Path):
     return [int(t) if t.isdigit() else t.lower()
-            for t in re.split(r'(\d+)', p.stem)]
+            for t in _NUMSPLIT.split(p.stem)]
 
 png_files = sorted(folder.glob("*.png"), key=natural_key)
 
 if not png_files:
     raise FileNotFoundError("Không tìm thấy ảnh PNG.")
 
+# Đọc song song các file PNG (I/O nhả GIL) trước khi ghép, giữ nguyên thứ tự đã sort
+with ThreadPoolExecutor(max_workers=8) as executor:
+    png_bytes = list(executor.map(Path.read_bytes, png_files))
+
 with open(output_pdf, "wb") as f:
-    f.write(img2pdf.convert([str(p) for p in png_files]))
+    f.write(img2pdf.convert(png_bytes))
 print(f"Đã tạo PDF: {output_pdf}")
@@ -21,21 +21,24 @@ DO NOT include explanations, code blocks, or markdown. Output only raw JSON.
 
 SEARCH_AGENT_PROMPT = """
 Bạn là Search Agent. Nhiệm vụ:
-1. Nhận sub-query từ Main Agent trong {{search_query_{i+1}}}
-2. Sử dụng image_search tool để tìm k ảnh liên quan với {{search_query_{i+1}}}
+1. Nhận sub-query từ Main Agent trong {{search_query_{id}}}
+2. Sử dụng image_search tool để tìm k ảnh liên quan với {{search_query_{id}}}
 3. Trả về danh sách ảnh tìm được từ Milvus database
 Không cần quan tâm tới user query
 Hãy tìm kiếm ảnh phù hợp với sub-query được giao bằng cách gọi image_search tool.
 """
 
-VLM_AGENT_PROMPT = """You are a helpful and precise Vision-Language Agent that receives two inputs:
+# Câu trả lời cố định của VLM khi ảnh không chứa thông tin, workflow dựa vào đó để bỏ qua Aggregator
+VLM_UNKNOWN_ANSWER = "わかりません"
+
+VLM_AGENT_PROMPT = f"""You are a helpful and precise Vision-Language Agent that receives two inputs:
 1. A user question in Japanese (text)
 2. An image (context)
 
 Your task is to analyze the question and carefully examine the image to determine whether the answer can be found in the image content.
 
 - If the image contains enough information to answer the question, provide a concise and accurate answer in Japanese.
-- If the image does not contain enough information, respond in Japanese by saying that you do not know.
+- If the image does not contain enough information, respond with exactly: {VLM_UNKNOWN_ANSWER}
 - Do NOT fabricate or guess any information that is not clearly shown in the image.
 - Do NOT explain your reasoning.
 - Only use Japanese in your answer.
@@ -60,4 +63,9 @@ Rules:
 
 Now, receive the Japanese responses from the VLM agents and produce your final Japanese answer based only on those responses.
 
+### User question:
+{user_query}
+
+### VLM agent answers:
+{vlm_answers?}
 """
\ No newline at end of file
@@ -0,0 +1,27 @@
+import pytest
+
+from utils.helper_workflow import is_simple_query
+
+
+@pytest.mark.parametrize("query", [
+    "温度差荷重の記号について教えてください",
+    "鉄骨の設計基準は？",
+])
+def test_short_japanese_query_takes_fast_path(query):
+    assert is_simple_query(query)
+
+
+@pytest.mark.parametrize("query", [
+    # Không phải tiếng Nhật: Main Agent phải dịch sang sub-query tiếng Nhật
+    "Cấu trúc của một tòa nhà như thế nào?",
+    "What is a temperature load?",
+    "RC造とは？",
+    "",
+    "   ",
+    # Nhiều ý hoặc quá dài
+    "温度差荷重と鉄骨の設計基準の違い",
+    "温度差荷重の記号、鉄骨の設計基準",
+    "温度差荷重の記号について教えてください。" * 3,
+])
+def test_other_queries_go_through_main_agent(query):
+    assert not is_simple_query(query)
@@ -1,7 +1,18 @@
-import requests
-import base64
+import asyncio
+import binascii
+import contextlib
 import os
-from typing import Dict, Any
+import uuid
+import weakref
+import httpx
+try:
+    # pybase64 giải mã bằng SIMD, nhanh hơn nhiều so với base64 chuẩn với ảnh lớn
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Tuple
 from utils.helper_workflow import load_config
 CONFIG_PATH = os.path.join(os.path.dirname(__file__),"..", "config", "config.yaml")
 config = load_config(config_path=CONFIG_PATH)
@@ -9,22 +20,98 @@ config = load_config(config_path=CONFIG_PATH)
 def agent_tool(func):
     return func
 API_URL = config["milvus"]["search_url"]
+# Một AsyncClient cho mỗi event loop (client gắn với loop tạo ra nó), dùng chung cho mọi Api instance
+# để giữ kết nối keep-alive tới Milvus API
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+def _make_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=config["milvus"].get("request_timeout", 30.0),
+        limits=httpx.Limits(max_keepalive_connections=16),
+    )
+
+def _get_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = _make_client()
+    return client
+# Pool ghi file ảnh song song: các ảnh của một lần search được ghi cùng lúc thay vì lần lượt
+_write_pool = ThreadPoolExecutor(max_workers=8)
+
+# Số ký tự base64 giải mã mỗi lần (bội số của 4)
+_DECODE_CHUNK = 64 * 1024
+
+def _write_base64_file(path: str, image_base64: str) -> None:
+    """Giải mã ảnh base64 theo từng đoạn và ghi thẳng vào file, không giữ cả ảnh đã giải mã trong bộ nhớ"""
+    # Bỏ prefix "data:image/png;base64," nếu có (find trả về -1 khi không có dấu phẩy)
+    start = image_base64.find(",") + 1
+    # Ghi vào file tạm cùng thư mục rồi os.replace: query khác đang đọc cùng ảnh
+    # chỉ thấy bản cũ hoặc bản mới đầy đủ, không bao giờ thấy file bị truncate/ghi dở
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            try:
+                # validate=True: ký tự ngoài bảng base64 (khoảng trắng, \r, \n...) làm các đoạn
+                # không còn thẳng hàng 4 ký tự, nên báo lỗi thay vì giải mã sai
+                for offset in range(start, len(image_base64), _DECODE_CHUNK):
+                    f.write(b64decode(image_base64[offset:offset + _DECODE_CHUNK], validate=True))
+            except binascii.Error:
+                # Giải mã lại cả payload một lần, bỏ qua các ký tự ngoài bảng base64
+                f.seek(0)
+                f.truncate()
+                f.write(b64decode(image_base64[start:]))
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Lỗi giải mã/ghi: xoá file tạm, giữ nguyên file cũ (nếu có)
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
 class Api:
     
-    def __init__(self, output_folder: str = config["paths"]["tools_results"]):
+    def __init__(self, output_folder: str = config["paths"]["tools_results"],
+                 result_cache_size: int = config["milvus"].get("result_cache_size", 64)):
         self.output_folder = output_folder
         os.makedirs(self.output_folder, exist_ok=True)
+        # Kết quả gần đây theo (query, k): các Search agent trùng sub-query chỉ gọi API một lần
+        self.result_cache_size = result_cache_size
+        self._recent_results: "OrderedDict[Tuple[str, int], Dict[str, Any]]" = OrderedDict()
+        # Request đang chạy theo (query, k): Search agent song song trùng sub-query chờ chung một request
+        self._pending: "Dict[Tuple[str, int], asyncio.Future]" = {}
     
     @agent_tool
-    def image_search(self, query: str, k: int = config["milvus"]["default_top_k"]) -> Dict[str, Any]:
+    async def image_search(self, query: str, k: int = config["milvus"]["default_top_k"]) -> Dict[str, Any]:
+        cache_key = (query, k)
+        cached = self._recent_results.get(cache_key)
+        if cached is not None:
+            self._recent_results.move_to_end(cache_key)
+            return dict(cached)
+        pending = self._pending.get(cache_key)
+        if pending is None:
+            pending = self._pending[cache_key] = asyncio.ensure_future(self._search_and_cache(query, k))
+            pending.add_done_callback(lambda _: self._pending.pop(cache_key, None))
+        # shield: một agent bị huỷ không huỷ request mà agent khác đang chờ
+        return dict(await asyncio.shield(pending))
+
+    async def _search_and_cache(self, query: str, k: int) -> Dict[str, Any]:
+        result = await self._image_search(query, k)
+        if "error" not in result and self.result_cache_size > 0:
+            self._recent_results[(query, k)] = result
+            while len(self._recent_results) > self.result_cache_size:
+                self._recent_results.popitem(last=False)
+        return result
+
+    async def _image_search(self, query: str, k: int) -> Dict[str, Any]:
         try:
             payload = {"query": query, "top": k}
-            response = requests.post(API_URL, json=payload)
+            response = await _get_client().post(API_URL, json=payload)
             if response.status_code != 200:
                 return {"query": query, "total_found": 0, "images": [], "error": f"API error: {response.text}"}
             data = response.json()
             results = data.get("results", [])
             images = []
+            writes = []
             for res in results:
                 doc_id = res.get("doc_id")
                 score = res.get("score")
@@ -33,9 +120,7 @@ class Api:
                 local_filename = f"doc_{doc_id}.png"
                 local_path = os.path.join(self.output_folder, local_filename)
                 if image_base64:
-                    image_clean = image_base64.split(",")[1] if "," in image_base64 else image_base64
-                    with open(local_path, "wb") as f:
-                        f.write(base64.b64decode(image_clean))
+                    writes.append((local_path, image_base64))
                 images.append({
                     "id": f"doc_{doc_id}",
                     "path": local_path,
@@ -48,6 +133,12 @@ class Api:
                         "format": "png"
                     }
                 })
+            # Giải mã + ghi xong toàn bộ ảnh trước khi trả kết quả (VLM đọc ảnh theo path), không chặn event loop
+            if writes:
+                loop = asyncio.get_running_loop()
+                await asyncio.gather(*(
+                    loop.run_in_executor(_write_pool, _write_base64_file, path, data) for path, data in writes
+                ))
             return {
                 "query": query,
                 "total_found": len(images),
@@ -65,7 +156,7 @@ if __name__ == "__main__":
     tool = Api(output_folder=config["paths"]["tools_results"])
     query = "温度差荷重の記号"
     k = 3
-    results = tool.image_search(query=query, k=k)
+    results = asyncio.run(tool.image_search(query=query, k=k))
     print("\n=== Search Result ===")
     print(f"Query: {results['query']}")
     print(f"Total Found: {results['total_found']}")
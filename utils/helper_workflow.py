@@ -1,20 +1,51 @@
-import os
+import asyncio
+import atexit
 import logging
-from typing import List, Dict, Any, Optional
-from google.adk.agents.invocation_context import InvocationContext
+import queue
+import re
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import TYPE_CHECKING, List, Dict, Any, Optional
 from pathlib import Path
 import yaml
 import sys
 
+from utils.image_pack import pack_image
+
+if TYPE_CHECKING:
+    # Chỉ dùng cho type hint, tránh import google.adk khi chỉ cần config/logging
+    from google.adk.agents.invocation_context import InvocationContext
+
 logger = logging.getLogger(__name__)
 
-def extract_user_input(ctx: InvocationContext) -> str:
+# Dấu hiệu câu hỏi nhiều ý (liệt kê, so sánh) cần Main Agent chia nhỏ
+_MULTI_ASPECT = re.compile(
+    r"(および|及び|並びに|ならびに|それぞれ|比較|違い|[、,;；]"
+    r"|\b(?:and|compare|vs|versus|both|also)\b)",
+    re.IGNORECASE,
+)
+# Kana/kanji: index Milvus là tiếng Nhật nên chỉ query tiếng Nhật mới gửi thẳng cho SearchAgent được
+_JAPANESE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]")
+# Chữ Latin, kể cả chữ có dấu tiếng Việt (query tiếng Anh/Việt cần Main Agent dịch sang tiếng Nhật)
+_LATIN = re.compile(r"[A-Za-z\u00c0-\u024f\u1e00-\u1eff]")
+
+def extract_user_input(ctx: "InvocationContext") -> str:
     """Lấy input từ context"""
-    if hasattr(ctx, "request") and ctx.request and ctx.request.content:
-        if ctx.request.content.parts:
-            return ctx.request.content.parts[0].text
+    if ctx.user_content and ctx.user_content.parts:
+        return ctx.user_content.parts[0].text
     return ctx.session.state.get("user_query", "")
 
+def is_simple_query(query: str, max_length: int = 40) -> bool:
+    """Query tiếng Nhật ngắn, chỉ một ý thì không cần Main Agent chia (và dịch) thành sub-queries"""
+    query = (query or "").strip()
+    return (
+        0 < len(query) <= max_length
+        and _JAPANESE.search(query) is not None
+        and not _LATIN.search(query)
+        and query.count("?") + query.count("？") <= 1
+        and not _MULTI_ASPECT.search(query)
+    )
+
 def distribute_images_to_agents(
     all_images: List[Dict[str, Any]], vlm_agents: List
 ) -> List[List[Dict[str, Any]]]:
@@ -61,23 +92,25 @@ Please analyze this image and answer the user's question."""
     }
 
     image_path = image.get("path")
-    if image_path and os.path.exists(image_path):
-        try:
-            with open(image_path, "rb") as f:
-                image_data = f.read()
-                image_mime_type = "image/png"
-                vlm_input["image_part"] = types.Part(
-                    inline_data=types.Blob(
-                        mime_type=image_mime_type, data=image_data
-                    )
-                )
-            logger.info(f"[helpers] Image prepared: {image_path} ({len(image_data)} bytes)")
-        except Exception as e:
-            logger.error(f"[helpers] Error reading image {image_path}: {e}")
-            vlm_input["image_error"] = f"Cannot read image: {e}"
-    else:
-        logger.warning(f"[helpers] Image path not found: {image_path}")
+    try:
+        if not image_path:
+            raise FileNotFoundError(image_path)
+        # Ảnh được nén (WebP) và cache theo phiên bản file, xem utils/image_pack.py
+        # (pack_image tự stat file nên không cần os.path.exists trước).
+        # Đọc file + nén chạy trong thread để không chặn event loop khi nhiều ảnh xử lý song song
+        image_data, image_mime_type = await asyncio.to_thread(pack_image, image_path)
+        vlm_input["image_part"] = types.Part(
+            inline_data=types.Blob(
+                mime_type=image_mime_type, data=image_data
+            )
+        )
+        logger.info("[helpers] Image prepared: %s (%d bytes)", image_path, len(image_data))
+    except FileNotFoundError:
+        logger.warning("[helpers] Image path not found: %s", image_path)
         vlm_input["image_error"] = "Image file not found"
+    except Exception as e:
+        logger.error("[helpers] Error reading image %s: %s", image_path, e)
+        vlm_input["image_error"] = f"Cannot read image: {e}"
 
     return vlm_input
 
@@ -85,6 +118,10 @@ def load_config(config_path: Optional[str] = None) -> Dict[str, Any]:
     """
     Load configuration from YAML file.
 
+    The file is parsed once per process; later calls with the same path
+    (resolved, so relative spellings share the entry) return the same dict,
+    which callers must treat as read-only.
+
     Args:
         config_path: Path to config file. If None, uses default location.
 
@@ -95,11 +132,18 @@ def load_config(config_path: Optional[str] = None) -> Dict[str, Any]:
         SystemExit: If config file not found or cannot be parsed.
     """
     if config_path is None:
-        config_path = str(Path(__file__).resolve().parent.parent / "config" / "config.yaml")
-    
+        config_path = Path(__file__).resolve().parent.parent / "config" / "config.yaml"
+    return _load_config(str(Path(config_path).resolve()))
+
+# Dùng parser C của libyaml nếu PyYAML được build kèm, nếu không thì parser Python
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+@lru_cache(maxsize=8)
+def _load_config(config_path: str) -> Dict[str, Any]:
+    """Parse config YAML một lần cho mỗi đường dẫn tuyệt đối"""
     try:
-        with open(config_path, "r", encoding="utf-8") as file:
-            config = yaml.safe_load(file)
+        with open(config_path, "rb") as file:
+            config = yaml.load(file, Loader=_YAML_LOADER)
             logger.info(f"Configuration loaded from {config_path}")
             return config
     except FileNotFoundError:
@@ -112,3 +156,34 @@ def load_config(config_path: Optional[str] = None) -> Dict[str, Any]:
         logger.error(f"Unexpected error loading config: {e}")
         sys.exit(1)
 
+def setup_logging(
+    level: int = logging.INFO,
+    fmt: str = "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+) -> QueueListener:
+    """
+    Configure root logging through a QueueHandler.
+
+    Records are only enqueued on the calling thread (the event loop); writing
+    them to stderr happens on a background QueueListener thread.
+
+    Args:
+        level: Root logger level.
+        fmt: Format string for the stream handler.
+
+    Returns:
+        The started QueueListener (stopped automatically at exit).
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(fmt))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
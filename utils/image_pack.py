@@ -0,0 +1,52 @@
+import io
+import logging
+import os
+from functools import lru_cache
+from typing import Tuple
+
+try:
+    from PIL import Image
+except ImportError:
+    # Không có Pillow: gửi nguyên file PNG
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Ảnh tài liệu nén WebP quality 85 vẫn đủ rõ cho VLM nhưng nhỏ hơn PNG nhiều lần
+PACK_FORMAT = "WEBP"
+PACK_MIME_TYPE = "image/webp"
+PACK_QUALITY = 85
+# Cạnh dài tối đa (px) của ảnh gửi cho VLM; ảnh lớn hơn được thu nhỏ (0 để giữ nguyên kích thước)
+MAX_SIDE = int(os.getenv("VLM_IMAGE_MAX_SIDE", "1024"))
+
+
+@lru_cache(maxsize=64)
+def _pack_image(image_path: str, mtime_ns: int, size: int) -> Tuple[bytes, str]:
+    """Đọc và nén ảnh một lần cho mỗi phiên bản file (key gồm mtime/size)"""
+    with open(image_path, "rb") as f:
+        raw = f.read()
+    if Image is None:
+        return raw, "image/png"
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            img = img.convert("RGB")
+            resized = MAX_SIDE > 0 and max(img.size) > MAX_SIDE
+            if resized:
+                # Ảnh lớn hơn kích thước tile của VLM chỉ tốn băng thông, thu nhỏ giữ tỉ lệ
+                img.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format=PACK_FORMAT, quality=PACK_QUALITY, method=6)
+    except Exception as e:
+        logger.warning("[image_pack] Cannot re-encode %s, sending original: %s", image_path, e)
+        return raw, "image/png"
+    packed = buf.getvalue()
+    if not resized and len(packed) >= len(raw):
+        return raw, "image/png"
+    logger.info("[image_pack] %s: %d -> %d bytes", image_path, len(raw), len(packed))
+    return packed, PACK_MIME_TYPE
+
+
+def pack_image(image_path: str) -> Tuple[bytes, str]:
+    """Bytes + mime type của ảnh để gửi cho VLM, dùng lại bản đã nén nếu file không thay đổi"""
+    stat = os.stat(image_path)
+    return _pack_image(image_path, stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,46 @@
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Chuẩn hoá query để các câu hỏi giống nhau dùng chung một key"""
+    query = unicodedata.normalize("NFKC", query or "")
+    return _WHITESPACE.sub(" ", query).strip().casefold()
+
+
+class PlanCache:
+    """Cache LRU cho kế hoạch sub-query của Main Agent, key theo query đã chuẩn hoá"""
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self._plans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, query: str) -> Optional[List[Dict[str, Any]]]:
+        """Lấy plan đã cache, None nếu chưa có"""
+        key = normalize_query(query)
+        if not key:
+            return None
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            logger.info("[plan_cache] Hit for query: %s", key)
+        return plan
+
+    def put(self, query: str, plan: List[Dict[str, Any]]) -> None:
+        """Lưu plan cho query, loại bỏ plan cũ nhất khi vượt quá max_size"""
+        if self.max_size <= 0 or not plan:
+            return
+        key = normalize_query(query)
+        if not key:
+            return
+        self._plans[key] = plan
+        self._plans.move_to_end(key)
+        while len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
@@ -0,0 +1,39 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from utils.plan_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class VLMAnswerCache:
+    """Cache LRU câu trả lời VLM, key theo nội dung ảnh + model + câu hỏi đã chuẩn hoá"""
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._answers: "OrderedDict[str, str]" = OrderedDict()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, model: str, query: str) -> str:
+        """Key theo nội dung ảnh (không theo đường dẫn/ID) để ảnh trùng nhau dùng chung câu trả lời"""
+        digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        return f"{model}:{digest}:{normalize_query(query)}"
+
+    def get(self, key: str) -> Optional[str]:
+        """Lấy câu trả lời đã cache, None nếu chưa có"""
+        answer = self._answers.get(key)
+        if answer is not None:
+            self._answers.move_to_end(key)
+            logger.info("[vlm_cache] Hit for image %s", key.split(":")[1])
+        return answer
+
+    def put(self, key: str, answer: str) -> None:
+        """Lưu câu trả lời, loại bỏ câu trả lời cũ nhất khi vượt quá max_size"""
+        if self.max_size <= 0 or not answer:
+            return
+        self._answers[key] = answer
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_size:
+            self._answers.popitem(last=False)
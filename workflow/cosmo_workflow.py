@@ -1,17 +1,23 @@
 import logging
-import json
-from typing import AsyncGenerator, List
+import orjson
+import os
+from collections import Counter
+from typing import AsyncGenerator, Dict, List
 from typing_extensions import override
 import asyncio
 from google.adk.agents import LlmAgent, BaseAgent, ParallelAgent
 from google.adk.agents.invocation_context import InvocationContext
 from google.genai import types
-from google.adk.events import Event
-from pydantic import BaseModel
+from google.adk.events import Event, EventActions
+from pydantic import BaseModel, PrivateAttr
 from utils.helper_workflow import (
     extract_user_input,
+    is_simple_query,
+    load_config,
 )
-from workflow.vlm_runner import run_all_vlm_batches
+from utils.plan_cache import PlanCache
+from prompt import VLM_UNKNOWN_ANSWER
+from workflow.vlm_runner import stream_vlm_batches
 # Import agents và tools
 from agent.agent import (
     search_agents,
@@ -21,6 +27,14 @@ from agent.agent import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config", "config.yaml")
+config = load_config(config_path=CONFIG_PATH)
+
+# Cache plan của Main Agent dùng chung cho mọi lần chạy workflow
+plan_cache = PlanCache(max_size=config["workflow"].get("plan_cache_size", 128))
+# Số lời gọi VLM chạy đồng thời tối đa (tránh 429 khi nhiều ảnh dùng chung một API key)
+MAX_CONCURRENT_VLM = config["workflow"].get("parallel", {}).get("max_concurrent_vlm")
+FAST_PATH = {"enabled": False, "max_query_length": 40, **config["workflow"].get("fast_path", {})}
 
 # --- Custom Orchestrator Agent ---
 class CosmoFlowAgent(BaseAgent):  
@@ -38,6 +52,9 @@ class CosmoFlowAgent(BaseAgent):
     # Store original agents for reference  
     search_agents: List[LlmAgent]  
     vlm_agents: List[LlmAgent]  
+
+    # Tên Search agent -> số thứ tự slot (search_query_{slot}), tính một lần khi khởi tạo
+    _search_slots: Dict[str, int] = PrivateAttr(default_factory=dict)
   
     # model_config allows setting Pydantic configurations  
     model_config = {"arbitrary_types_allowed": True}  
@@ -80,6 +97,7 @@ class CosmoFlowAgent(BaseAgent):
             vlm_agents=vlm_agents,        
             sub_agents=sub_agents_list,  
         )
+        self._search_slots = {agent.name: i + 1 for i, agent in enumerate(search_agents)}
     @override  
     async def _run_async_impl(  
         self, ctx: InvocationContext  
@@ -95,13 +113,25 @@ class CosmoFlowAgent(BaseAgent):
         logger.info(f"[{self.name}] User Query: {user_input}")  
   
         # Store user query in session  
-        ctx.session.state["user_query"] = user_input  
+        yield self._state_event(ctx, user_query=user_input)
   
         try:  
             # Step 1: Main Agent phân tích và chia task  
-            logger.info(f"[{self.name}] Step 1: Main Agent analyzing query...")  
-            async for event in self.main_agent.run_async(ctx):  
-                yield event  
+            cached_plan = plan_cache.get(user_input)
+            if cached_plan is not None:
+                # Query đã gặp trước đó: dùng lại plan, bỏ qua lời gọi Main Agent
+                logger.info(f"[{self.name}] Step 1: Reusing cached plan, skipping Main Agent")
+                yield self._state_event(ctx, task_results=cached_plan)
+            elif FAST_PATH["enabled"] and is_simple_query(user_input, FAST_PATH["max_query_length"]):
+                # Query ngắn, một ý: gửi thẳng cho SearchAgent đầu tiên, không cần chia nhỏ
+                logger.info(f"[{self.name}] Step 1: Simple query, skipping Main Agent")
+                yield self._state_event(
+                    ctx, task_results=[{"agent": self.search_agents[0].name, "query": user_input}]
+                )
+            else:
+                logger.info(f"[{self.name}] Step 1: Main Agent analyzing query...")  
+                async for event in self.main_agent.run_async(ctx):  
+                    yield event  
   
             # Check if task results were generated  
             if "task_results" not in ctx.session.state or not ctx.session.state["task_results"]:  
@@ -111,97 +141,209 @@ class CosmoFlowAgent(BaseAgent):
             # Parse task results  
             task_results = ctx.session.state.get("task_results")  
             if isinstance(task_results, str):  
-                search_tasks = json.loads(task_results)  
+                try:
+                    search_tasks = orjson.loads(task_results)
+                except orjson.JSONDecodeError as e:
+                    logger.error(f"[{self.name}] Invalid Sub-Tasks JSON from Main Agent: {e}. Aborting workflow.")
+                    # Để except bên dưới trả về event lỗi của root agent (không để output thô của Main Agent thành câu trả lời)
+                    raise
             else:  
                 search_tasks = task_results  
+            plan_cache.put(user_input, search_tasks)
   
-            # Set up search queries for parallel search  
-            for i, task in enumerate(search_tasks):  
-                if i < len(self.search_agents):  
-                    # Sử dụng key riêng cho từng agent  
-                    ctx.session.state[f"search_query_{i+1}"] = task["query"]  
-                    logger.info(f"[{self.name}] Set query for SearchAgent{i+1}: {task['query']}")
-            # Step 2: Parallel Search Agents  
-            
-            logger.info(f"[{self.name}] Step 2: Search Agents working in parallel...")  
-            search_results = []  
-            async for event in self.parallel_search.run_async(ctx):  
-                logger.info(f"[{self.name}] Search event: {event.author}")  
+            # Set up search queries: duyệt plan đúng một lần, mỗi task được giao cho một slot riêng
+            selected_slots = set()
+            search_queries = {}
+            for i, task in enumerate(search_tasks):
+                # Ưu tiên agent được Main Agent chỉ định, nếu không có thì theo thứ tự
+                slot = self._search_slots.get(task.get("agent"), i + 1)
+                if slot in selected_slots or slot > len(self.search_agents):
+                    # Agent bị trùng hoặc không hợp lệ: chuyển sang slot còn trống đầu tiên
+                    slot = next(
+                        (s for s in range(1, len(self.search_agents) + 1) if s not in selected_slots),
+                        None,
+                    )
+                    if slot is None:
+                        logger.warning(f"[{self.name}] No free Search agent for query: {task['query']}")
+                        continue
+                selected_slots.add(slot)
+                # Sử dụng key riêng cho từng agent
+                search_queries[f"search_query_{slot}"] = task["query"]
+                logger.info("[%s] Set query for SearchAgent%d: %s", self.name, slot, task["query"])
+            if search_queries:
+                yield self._state_event(ctx, **search_queries)
+            # Step 2: Parallel Search Agents (chỉ chạy các agent đã được giao query)
+
+            logger.info(f"[{self.name}] Step 2: {len(selected_slots)} Search Agents working in parallel...")
+            search_results = []
+            search_runs = [
+                agent.run_async(self._create_search_branch_ctx(ctx, agent))
+                for slot, agent in enumerate(self.search_agents, start=1)
+                if slot in selected_slots
+            ]
+            # Đếm event theo agent, log một lần sau khi search xong thay vì log từng event
+            search_event_counts = Counter()
+            async for event in merge_agent_runs(search_runs):  
+                search_event_counts[event.author] += 1
                   
                 # Collect search results from function responses  
-                if (hasattr(event, "content") and event.content and event.content.parts):  
-                    for part in event.content.parts:  
-                        if (hasattr(part, "function_response") and part.function_response):  
-                            response_data = part.function_response.response  
+                content = event.content
+                found_images = False
+                if content and content.parts:
+                    for part in content.parts:
+                        function_response = part.function_response
+                        if function_response:
+                            response_data = function_response.response
                             if (isinstance(response_data, dict) and "images" in response_data):  
                                 images = response_data["images"]  
                                 search_results.extend(images)  
-                                logger.info(f"[{self.name}] {event.author}: Found {len(images)} images")  
+                                found_images = True
+                                logger.info("[%s] %s: Found %d images", self.name, event.author, len(images))
                   
                 yield event  
+                if found_images:
+                    # Lưu ngay kết quả search vào session (bản chụp, list vẫn tiếp tục được thêm)
+                    yield self._state_event(ctx, search_images=list(search_results))
   
+            logger.info(f"[{self.name}] Search events: {dict(search_event_counts)}")
             logger.info(f"[{self.name}] Total images found: {len(search_results)}")  
             
             # Step 3: VLM Agents phân tích ảnh song song
             logger.info(f"[{self.name}] Step 3: VLM Agents analyzing images...")
             
+            final_answer = None
             if not search_results:
                 logger.warning(f"[{self.name}] No images found, skipping VLM analysis")
                 final_answer = "Xin lỗi, không tìm thấy hình ảnh liên quan đến câu hỏi của bạn."
             else:
-                # Store images for VLM processing
-                ctx.session.state["search_images"] = search_results
-                
-                # Sử dụng VLM runner để xử lý ảnh song song
-                all_vlm_results = await run_all_vlm_batches(user_input, search_results, self.vlm_agents)
-                
-                # Yield events để maintain ADK pattern
-                for batch_result in all_vlm_results:
+                # Sử dụng VLM runner để xử lý ảnh song song, nhận kết quả ngay khi từng ảnh xong
+                # Ghi từng kết quả vào session ngay khi có (không đợi cả stage xong)
+                all_vlm_results = []
+                async for batch_result in stream_vlm_batches(
+                    user_input, search_results, self.vlm_agents, MAX_CONCURRENT_VLM
+                ):
+                    all_vlm_results.append(batch_result)
                     # Tạo event từ VLM result để yield
                     vlm_content = types.Content(
                         role="assistant",
                         parts=[types.Part(text=batch_result["response"])]
                     )
+                    # Mỗi kết quả VLM được lưu vào session cùng event của nó
                     vlm_event = Event(
                         author=batch_result["vlm_agent"],
-                        content=vlm_content
+                        content=vlm_content,
+                        actions=EventActions(state_delta={"vlm_results": list(all_vlm_results)}),
                     )
                     yield vlm_event
                 
-                # Store VLM results for aggregator
-                ctx.session.state["vlm_results"] = all_vlm_results
                 logger.info(
                     f"[{self.name}] VLM processing completed: {len(all_vlm_results)} total results"
                 )
+                # Gộp câu trả lời VLM (bỏ trùng lặp, kết quả lỗi và các câu "không biết") thành một khối cho Aggregator
+                answers = dict.fromkeys(
+                    r["response"].strip() for r in all_vlm_results
+                    if "error" not in r and r["response"].strip()
+                )
+                known_answers = [a for a in answers if a.rstrip("。.") != VLM_UNKNOWN_ANSWER]
+                if known_answers:
+                    yield self._state_event(
+                        ctx, vlm_answers="\n".join(f"- {answer}" for answer in known_answers)
+                    )
+                else:
+                    logger.info(f"[{self.name}] No usable VLM answer (all unknown or failed), skipping Aggregator")
+                    final_answer = "Xin lỗi, không tìm thấy thông tin trả lời câu hỏi trong các hình ảnh liên quan."
             
-            # Step 4: Aggregator tổng hợp kết quả  
-            logger.info(f"[{self.name}] Step 4: Aggregating final results...")  
-            async for event in self.aggregator_agent.run_async(ctx):  
-                yield event  
-
-            # Get final answer  
-            final_answer = ctx.session.state.get("final_answer", "Không thể tạo câu trả lời cuối cùng.")  
+            # Step 4: Aggregator tổng hợp kết quả (chỉ khi có câu trả lời VLM để tổng hợp)
+            if final_answer is None:
+                logger.info(f"[{self.name}] Step 4: Aggregating final results...")  
+                async for event in self.aggregator_agent.run_async(ctx):  
+                    yield event  
 
-            # Store final answer  
-            ctx.session.state["final_answer"] = final_answer  
+                # Get final answer  
+                final_answer = ctx.session.state.get("final_answer", "Không thể tạo câu trả lời cuối cùng.")  
 
-            # Yield final response event  
+            # Yield final response event (kèm final_answer để lưu vào session)  
             final_content = types.Content(  
                 role="assistant", parts=[types.Part(text=final_answer)]  
             )  
-            final_event = Event(author=self.name, content=final_content)  
+            final_event = Event(
+                author=self.name,
+                content=final_content,
+                actions=EventActions(state_delta={"final_answer": final_answer}),
+            )
             yield final_event  
 
             logger.info(f"[{self.name}] Cosmo workflow completed successfully.")  
 
         except Exception as e:  
-            logger.error(f"[{self.name}] Workflow error: {str(e)}")  
+            err = str(e)
+            logger.error("[%s] Workflow error: %s", self.name, err)
             error_content = types.Content(  
                 role="assistant",  
-                parts=[types.Part(text=f"Xin lỗi, có lỗi xảy ra: {str(e)}")],  
+                parts=[types.Part(text=f"Xin lỗi, có lỗi xảy ra: {err}")],  
             )  
             error_event = Event(author=self.name, content=error_content)  
             yield error_event  
+
+    def _state_event(self, ctx: InvocationContext, **state_delta) -> Event:
+        """
+        Event chỉ mang state_delta.
+
+        ctx.session là bản sao của session trong session service: ghi thẳng vào
+        ctx.session.state không được lưu lại, còn state_delta của event được Runner
+        áp dụng cho cả ctx.session lẫn session đã lưu trước khi workflow chạy tiếp.
+        """
+        return Event(
+            invocation_id=ctx.invocation_id,
+            author=self.name,
+            branch=ctx.branch,
+            actions=EventActions(state_delta=state_delta),
+        )
+
+    def _create_search_branch_ctx(
+        self, ctx: InvocationContext, sub_agent: BaseAgent
+    ) -> InvocationContext:
+        """Tạo nhánh riêng cho từng Search agent (cùng quy ước branch với ParallelAgent)"""
+        branch_ctx = ctx.model_copy()
+        branch_suffix = f"{self.parallel_search.name}.{sub_agent.name}"
+        branch_ctx.branch = f"{ctx.branch}.{branch_suffix}" if ctx.branch else branch_suffix
+        return branch_ctx
+
+
+async def merge_agent_runs(
+    agent_runs: List[AsyncGenerator[Event, None]],
+) -> AsyncGenerator[Event, None]:
+    """
+    Gộp event từ nhiều agent chạy song song.
+
+    Mỗi agent chỉ chạy tiếp sau khi event trước của nó đã được xử lý ở upstream
+    (giống ParallelAgent), nhưng tra generator theo dict task -> generator
+    thay vì quét lại danh sách task cho mỗi event.
+    """
+    pending = {
+        asyncio.create_task(agent_run.__anext__()): agent_run
+        for agent_run in agent_runs
+    }
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                agent_run = pending.pop(task)
+                try:
+                    event = task.result()
+                except StopAsyncIteration:
+                    continue
+                yield event
+                pending[asyncio.create_task(agent_run.__anext__())] = agent_run
+    finally:
+        # Consumer dừng sớm: huỷ và chờ các bước đang chạy, rồi đóng generator của từng agent
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for agent_run in agent_runs:
+            await agent_run.aclose()
+
+
 logger.info(  
     f"✅ CosmoFlowAgent initialized with {len(search_agents)} search agents and {len(vlm_agents)} VLM agents"  
 )
\ No newline at end of file
@@ -1,80 +1,171 @@
 import asyncio
+import contextlib
 import logging
+import os
 from google.genai import types
 from google.adk.events import Event
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
 
-from utils.helper_workflow import distribute_images_to_agents, prepare_vlm_input_with_image
+from utils.helper_workflow import distribute_images_to_agents, load_config, prepare_vlm_input_with_image
+from utils.vlm_cache import VLMAnswerCache
 
 logger = logging.getLogger(__name__)
 
-async def run_vlm_agent_batch(agent, images_batch, user_input, agent_idx):
-    batch_results = []
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config", "config.yaml")
+config = load_config(config_path=CONFIG_PATH)
 
-    for i, image in enumerate(images_batch):
-        try:
-            vlm_input = await prepare_vlm_input_with_image(user_input, image, types)
+# Cache câu trả lời VLM dùng chung cho mọi lần chạy workflow
+vlm_answer_cache = VLMAnswerCache(max_size=config["workflow"].get("vlm_cache_size", 256))
 
-            content_parts = [types.Part(text=vlm_input["text_input"])]
-            if "image_part" in vlm_input:
-                content_parts.append(vlm_input["image_part"])
+# Đánh dấu một batch đã chạy xong trong queue
+_SENTINEL = object()
 
-            vlm_content = types.Content(role="user", parts=content_parts)
-            vlm_session_service = InMemorySessionService()
-            vlm_runner = Runner(
-                agent=agent,
-                app_name="CosmoVLM",
-                session_service=vlm_session_service,
-            )
-
-            vlm_session_id = f"vlm_{agent.name}_{image.get('id', 'unknown')}"
-            vlm_user_id = "vlm_user"
-            await vlm_session_service.create_session(
-                app_name="CosmoVLM",
-                user_id=vlm_user_id,
-                session_id=vlm_session_id,
-                state={},
-            )
+async def run_vlm_agent_on_image(agent, image, user_input, agent_idx, i, vlm_runner, semaphore=None):
+    """Chạy một VLM agent trên một ảnh (Runner của agent dùng chung cho mọi ảnh trong lượt chạy)"""
+    # Giới hạn số lời gọi VLM đồng thời để không vượt quota của API key
+    async with semaphore or contextlib.nullcontext():
+        return await _run_vlm_agent_on_image(agent, image, user_input, agent_idx, i, vlm_runner)
 
-            vlm_response = ""
-            async for event in vlm_runner.run_async(
-                user_id=vlm_user_id, session_id=vlm_session_id, new_message=vlm_content
-            ):
-                if event.content and event.content.parts and event.content.parts[0].text:
-                    vlm_response = event.content.parts[0].text
-                    break
+async def _run_vlm_agent_on_image(agent, image, user_input, agent_idx, i, vlm_runner):
+    try:
+        vlm_input = await prepare_vlm_input_with_image(user_input, image, types)
 
-            batch_results.append(
-                {
-                    "image_id": image.get("id", f"batch_{agent_idx}_img_{i}"),
-                    "vlm_agent": agent.name,
-                    "response": vlm_response,
-                }
+        content_parts = [types.Part(text=vlm_input["text_input"])]
+        cache_key = None
+        if "image_part" in vlm_input:
+            content_parts.append(vlm_input["image_part"])
+            # Ảnh + câu hỏi đã được trả lời trước đó: dùng lại, không gọi VLM
+            cache_key = vlm_answer_cache.make_key(
+                vlm_input["image_part"].inline_data.data, agent.canonical_model.model, user_input
             )
-            logger.info(f"[vlm_runner] {agent.name} processed {image.get('id')}")
-        except Exception as e:
-            logger.error(f"[vlm_runner] Error: {e}")
-            batch_results.append(
-                {
+            cached_answer = vlm_answer_cache.get(cache_key)
+            if cached_answer is not None:
+                return {
                     "image_id": image.get("id", f"batch_{agent_idx}_img_{i}"),
                     "vlm_agent": agent.name,
-                    "response": f"Lỗi xử lý ảnh: {str(e)}",
+                    "response": cached_answer,
                 }
-            )
-    return batch_results
 
-async def run_all_vlm_batches(user_input, search_results, vlm_agents):
-    """Chạy song song tất cả VLM agents"""
-    image_batches = distribute_images_to_agents(search_results, vlm_agents)
+        vlm_content = types.Content(role="user", parts=content_parts)
+
+        vlm_session_id = f"vlm_{agent.name}_{image.get('id', 'unknown')}_{i}"
+        vlm_user_id = "vlm_user"
+        await vlm_runner.session_service.create_session(
+            app_name="CosmoVLM",
+            user_id=vlm_user_id,
+            session_id=vlm_session_id,
+            state={},
+        )
+
+        vlm_response = ""
+        async for event in vlm_runner.run_async(
+            user_id=vlm_user_id, session_id=vlm_session_id, new_message=vlm_content
+        ):
+            if event.content and event.content.parts and event.content.parts[0].text:
+                vlm_response = event.content.parts[0].text
+                break
+
+        if cache_key is not None:
+            vlm_answer_cache.put(cache_key, vlm_response)
+        logger.info("[vlm_runner] %s processed %s", agent.name, image.get("id"))
+        return {
+            "image_id": image.get("id", f"batch_{agent_idx}_img_{i}"),
+            "vlm_agent": agent.name,
+            "response": vlm_response,
+        }
+    except Exception as e:
+        err = str(e)
+        logger.error("[vlm_runner] Error: %s", err)
+        return {
+            "image_id": image.get("id", f"batch_{agent_idx}_img_{i}"),
+            "vlm_agent": agent.name,
+            "response": f"Lỗi xử lý ảnh: {err}",
+            # Đánh dấu kết quả lỗi để workflow không coi đây là câu trả lời
+            "error": err,
+        }
+
+async def iter_vlm_agent_batch(agent, images_batch, user_input, agent_idx, vlm_session_service, semaphore=None):
+    """Xử lý song song các ảnh của một VLM agent, yield kết quả theo thứ tự hoàn thành"""
+    # Một Runner cho mỗi agent, mỗi ảnh chỉ cần session riêng
+    vlm_runner = Runner(
+        agent=agent,
+        app_name="CosmoVLM",
+        session_service=vlm_session_service,
+    )
     tasks = [
-        run_vlm_agent_batch(vlm_agents[i], batch, user_input, i + 1)
+        asyncio.ensure_future(
+            run_vlm_agent_on_image(agent, image, user_input, agent_idx, i, vlm_runner, semaphore)
+        )
+        for i, image in enumerate(images_batch)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _pump(results, queue):
+    """Đẩy kết quả của một batch vào queue, luôn kết thúc bằng sentinel"""
+    try:
+        async for result in results:
+            await queue.put(result)
+    finally:
+        queue.put_nowait(_SENTINEL)
+
+def group_duplicate_images(search_results):
+    """Gom các ảnh trùng id, giữ thứ tự xuất hiện đầu tiên (ảnh không có id không bị gộp)"""
+    groups = {}
+    for image in search_results:
+        groups.setdefault(image.get("id", id(image)), []).append(image)
+    return groups
+
+async def stream_vlm_batches(user_input, search_results, vlm_agents, max_concurrent=None):
+    """Chạy song song tất cả VLM agents, yield từng kết quả ngay khi có (tối đa max_concurrent ảnh cùng lúc)"""
+    # Nhiều sub-query có thể trả về cùng một ảnh: mỗi ảnh chỉ gọi VLM một lần
+    image_groups = group_duplicate_images(search_results)
+    if len(image_groups) < len(search_results):
+        logger.info(
+            "[vlm_runner] %d duplicate images skipped", len(search_results) - len(image_groups)
+        )
+    unique_images = [images[0] for images in image_groups.values()]
+    image_batches = distribute_images_to_agents(unique_images, vlm_agents)
+    # Một session service cho cả lượt chạy, mỗi ảnh chỉ cần một session riêng
+    vlm_session_service = InMemorySessionService()
+    semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+    # Queue không giới hạn: số phần tử tối đa bằng số ảnh nên không cần backpressure
+    queue = asyncio.Queue()
+    pumps = [
+        asyncio.create_task(
+            _pump(
+                iter_vlm_agent_batch(vlm_agents[i], batch, user_input, i + 1, vlm_session_service, semaphore),
+                queue,
+            )
+        )
         for i, batch in enumerate(image_batches) if batch
     ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
 
-    all_results = []
-    for r in results:
-        if isinstance(r, list):
-            all_results.extend(r)
-    return all_results
+    pumps_alive = len(pumps)
+    try:
+        while pumps_alive:
+            result = await queue.get()
+            if result is _SENTINEL:
+                pumps_alive -= 1
+                continue
+            # Trả kết quả cho mọi vị trí dùng chung ảnh để số kết quả bằng số ảnh tìm được
+            duplicates = image_groups.get(result["image_id"], ())
+            yield result
+            for _ in range(len(duplicates) - 1):
+                yield dict(result)
+    finally:
+        # Consumer dừng sớm thì huỷ các batch còn đang chạy
+        for pump in pumps:
+            pump.cancel()
+        for r in await asyncio.gather(*pumps, return_exceptions=True):
+            if isinstance(r, Exception):
+                logger.error("[vlm_runner] VLM batch failed: %s", r)
+
+async def run_all_vlm_batches(user_input, search_results, vlm_agents, max_concurrent=None):
+    """Chạy song song tất cả VLM agents"""
+    return [r async for r in stream_vlm_batches(user_input, search_results, vlm_agents, max_concurrent)]